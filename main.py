@@ -1,17 +1,21 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response
 from pydantic import BaseModel
-import json
+import asyncio
+import orjson
 import uuid
 import random
+import secrets
 import os
 import pyfiglet
 import logging
-from typing import Dict, List
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging (LOG_LEVEL=WARNING in production keeps the hot paths quiet)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -26,8 +30,37 @@ app.add_middleware(
 )
 
 # In-memory storage
-rooms: Dict[str, dict] = {}
-connections: Dict[str, List[WebSocket]] = {}
+rooms: Dict[str, "Room"] = {}
+# Room id -> {websocket: outbound queue}; insertion-ordered, O(1) removal
+connections: Dict[str, Dict[WebSocket, asyncio.Queue]] = {}
+
+# Optional cross-worker fan-out. With REDIS_URL set, broadcasts are published to
+# channel:{room_id} and every process relays them to its own local connections.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+else:
+    redis_client = None
+room_listeners: Dict[str, asyncio.Task] = {}
+
+# Outbound frames buffered per client before it is treated as too slow
+OUTBOUND_QUEUE_SIZE = 32
+# Large fan-outs yield to the event loop between batches of this size
+BROADCAST_BATCH_SIZE = 50
+
+# Rendered once at import; figlet re-parses its font file on every call
+ROOT_BANNER = (pyfiglet.figlet_format("Ludo Backend Running", font="slant") + "\nStatus: running").encode()
+
+# Board layout: squares past HOME_ENTRY are the colour's final stretch
+HOME_ENTRY = 51
+FINAL_HOME = 57
+SAFE_MASK = sum(1 << i for i in (1, 9, 14, 22, 27, 35, 40, 48))
+
+# Per-colour tables, indexed by the player's colour number
+COLORS = ("red", "blue", "green", "yellow")
+COLOR_PREFIX = ("r", "b", "g", "y")
+START_POS = (1, 40, 14, 27)
 
 # Pydantic models
 class CreateRoomRequest(BaseModel):
@@ -37,10 +70,130 @@ class JoinRoomRequest(BaseModel):
     room_id: str
     player_name: str
 
+def piece_position(color: int, index: int, home: bool) -> str:
+    if home:
+        return "home"
+    if index <= HOME_ENTRY:
+        return str(index)
+    return f"{COLOR_PREFIX[color]}f{index}"
+
+def leave_square(occupants: Dict[int, List[int]], square: int, slot: int):
+    occupants[square].remove(slot)
+    if not occupants[square]:
+        del occupants[square]
+
+# Game state
+@dataclass(slots=True)
+class Player:
+    id: str
+    name: str
+    color: int
+    piece_ids: List[str]
+    # Piece id -> position in piece_ids
+    piece_by_id: Dict[str, int] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.piece_by_id = {piece_id: k for k, piece_id in enumerate(self.piece_ids)}
+
+@dataclass(slots=True)
+class Room:
+    id: str
+    players: List[Player]
+    current_turn: int = 0
+    game_state: str = "waiting"
+    dice_result: Optional[int] = None
+    max_players: int = 4
+    # Piece state as parallel arrays; player p owns slots 4p..4p+3
+    piece_indices: List[int] = field(default_factory=lambda: [0] * 16)
+    piece_home: List[bool] = field(default_factory=lambda: [True] * 16)
+    piece_owner: List[int] = field(default_factory=lambda: [0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3])
+    # Board square -> slots of the pieces standing on it (pieces at home are not tracked)
+    occupant_by_square: Dict[int, List[int]] = field(default_factory=dict)
+    # Held around every read-modify-write of the room and the broadcast that follows it
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+    _wire: Optional[dict] = field(default=None, init=False, repr=False)
+    _wire_cache: Optional[bytes] = field(default=None, init=False, repr=False)
+
+    # Must be called after every state change so to_wire() and wire() are rebuilt
+    def invalidate(self):
+        self._wire = None
+        self._wire_cache = None
+
+    # Client-facing room dict (with per-player pieces), used by the HTTP API
+    def to_dict(self) -> dict:
+        indices = self.piece_indices
+        home = self.piece_home
+        return {
+            "id": self.id,
+            "players": [
+                {
+                    "id": player.id,
+                    "name": player.name,
+                    "color": COLORS[player.color],
+                    "pieces": [
+                        {
+                            "id": piece_id,
+                            "position": piece_position(player.color, indices[p * 4 + k], home[p * 4 + k]),
+                            "index": indices[p * 4 + k],
+                            "home": home[p * 4 + k],
+                        }
+                        for k, piece_id in enumerate(player.piece_ids)
+                    ],
+                }
+                for p, player in enumerate(self.players)
+            ],
+            "current_turn": self.current_turn,
+            "game_state": self.game_state,
+            "dice_result": self.dice_result,
+            "max_players": self.max_players,
+        }
+
+    # Websocket wire format: same content as to_dict() under short keys, with
+    # colours as indices into COLORS and positions left for the client to derive.
+    # Built once per state change and reused until invalidate().
+    def to_wire(self) -> dict:
+        if self._wire is None:
+            indices = self.piece_indices
+            home = self.piece_home
+            self._wire = {
+                "i": self.id,
+                "t": self.current_turn,
+                "s": self.game_state,
+                "d": self.dice_result,
+                "m": self.max_players,
+                "pl": [
+                    {
+                        "id": player.id,
+                        "n": player.name,
+                        "c": player.color,
+                        "pc": [
+                            {"id": piece_id, "i": indices[p * 4 + k], "h": home[p * 4 + k]}
+                            for k, piece_id in enumerate(player.piece_ids)
+                        ],
+                    }
+                    for p, player in enumerate(self.players)
+                ],
+            }
+        return self._wire
+
+    # Encoded room_update frame, shared by connects, resyncs and join broadcasts
+    def wire(self) -> bytes:
+        if self._wire_cache is None:
+            self._wire_cache = encode_frame({
+                "type": "room_update",
+                "room": self.to_wire()
+            })
+        return self._wire_cache
+
+# Outbound frames are zlib-compressed JSON sent as binary messages. Compressing
+# here means a broadcast is compressed once, not once per connection, so
+# websocket-level permessage-deflate is switched off (see uvicorn.run / Procfile).
+def encode_frame(message: dict) -> bytes:
+    return zlib.compress(orjson.dumps(message), 1)
+
 @app.get("/")
 async def root():
-    ascii_art = pyfiglet.figlet_format("Ludo Backend Running", font="slant")
-    return PlainTextResponse(ascii_art + "\nStatus: running")
+    return Response(content=ROOT_BANNER, media_type="text/plain")
 
 @app.get("/health")
 async def health():
@@ -52,45 +205,35 @@ async def debug_rooms():
 
 @app.post("/create-room")
 async def create_room(request: CreateRoomRequest):
-    logger.info(f"Create room request: {request}")
+    logger.debug("Create room request: %r", request)
     player_name = request.player_name.strip()
     if not player_name:
         logger.error("Player name is empty")
         return {"detail": "Player name cannot be empty"}, 422
     
-    room_id = str(uuid.uuid4())[:8].upper()
-    room_data = {
-        "id": room_id,
-        "players": [{
-            "id": str(uuid.uuid4()),
-            "name": player_name,
-            "color": "red",
-            "pieces": [
-                {"id": f"{player_name}-r1", "position": "home", "index": 0, "home": True},
-                {"id": f"{player_name}-r2", "position": "home", "index": 0, "home": True},
-                {"id": f"{player_name}-r3", "position": "home", "index": 0, "home": True},
-                {"id": f"{player_name}-r4", "position": "home", "index": 0, "home": True},
-            ],
-        }],
-        "current_turn": 0,
-        "game_state": "waiting",
-        "dice_result": None,
-        "max_players": 4
-    }
+    room_id = secrets.token_hex(4).upper()
+    while room_id in rooms:
+        room_id = secrets.token_hex(4).upper()
+    room_data = Room(id=room_id, players=[Player(
+        id=str(uuid.uuid4()),
+        name=player_name,
+        color=0,
+        piece_ids=[f"{player_name}-r1", f"{player_name}-r2", f"{player_name}-r3", f"{player_name}-r4"],
+    )])
     
     rooms[room_id] = room_data
-    connections[room_id] = []
+    connections[room_id] = {}
     logger.info(f"Room created: {room_id}")
     
     return {
         "room_id": room_id,
-        "player_id": room_data["players"][0]["id"],
+        "player_id": room_data.players[0].id,
         "message": f"Room {room_id} created!"
     }
 
 @app.post("/join-room")
-async def join_room(request: JoinRoomRequest, raw_request: Request):
-    logger.info(f"Join room request: {request}")
+async def join_room(request: JoinRoomRequest):
+    logger.debug("Join room request: %r", request)
     room_id = request.room_id.upper().strip()
     player_name = request.player_name.strip()
     
@@ -103,36 +246,35 @@ async def join_room(request: JoinRoomRequest, raw_request: Request):
         return {"detail": "Room not found"}, 404
     
     room = rooms[room_id]
-    if len(room["players"]) >= room["max_players"]:
-        logger.error(f"Room full: {room_id}")
-        return {"detail": "Room full"}, 400
-    
-    colors = ["red", "blue", "green", "yellow"]
-    player_color = colors[len(room["players"])]
-    
-    new_player = {
-        "id": str(uuid.uuid4()),
-        "name": player_name,
-        "color": player_color,
-        "pieces": [
-            {"id": f"{player_name}-{player_color}1", "position": "home", "index": 0, "home": True},
-            {"id": f"{player_name}-{player_color}2", "position": "home", "index": 0, "home": True},
-            {"id": f"{player_name}-{player_color}3", "position": "home", "index": 0, "home": True},
-            {"id": f"{player_name}-{player_color}4", "position": "home", "index": 0, "home": True},
-        ],
-    }
-    
-    room["players"].append(new_player)
-    logger.info(f"Player {player_name} joined room {room_id}")
-    
-    await broadcast_to_room(room_id, {
-        "type": "room_update",
-        "room": room
-    })
+    async with room.lock:
+        if len(room.players) >= room.max_players:
+            logger.error(f"Room full: {room_id}")
+            return {"detail": "Room full"}, 400
+        
+        color = len(room.players)
+        player_color = COLORS[color]
+        
+        new_player = Player(
+            id=str(uuid.uuid4()),
+            name=player_name,
+            color=color,
+            piece_ids=[
+                f"{player_name}-{player_color}1",
+                f"{player_name}-{player_color}2",
+                f"{player_name}-{player_color}3",
+                f"{player_name}-{player_color}4",
+            ],
+        )
+        
+        room.players.append(new_player)
+        room.invalidate()
+        logger.info(f"Player {player_name} joined room {room_id}")
+        
+        await broadcast_frame(room_id, room.wire())
     
     return {
         "room_id": room_id,
-        "player_id": new_player["id"],
+        "player_id": new_player.id,
         "message": f"Joined room {room_id}!"
     }
 
@@ -142,7 +284,7 @@ async def get_room(room_id: str):
     if room_id not in rooms:
         logger.error(f"Room not found: {room_id}")
         return {"detail": "Room not found"}, 404
-    return {"room": rooms[room_id]}
+    return {"room": rooms[room_id].to_dict()}
 
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str):
@@ -150,123 +292,212 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
     
     room_id = room_id.upper()
     if room_id not in connections:
-        connections[room_id] = []
-    connections[room_id].append(websocket)
+        connections[room_id] = {}
+    queue: asyncio.Queue = asyncio.Queue(OUTBOUND_QUEUE_SIZE)
+    connections[room_id][websocket] = queue
+    relay_task = asyncio.create_task(relay(room_id, websocket, queue))
     
     try:
+        if redis_client is not None and room_id not in room_listeners:
+            # Subscribe before serving the client so none of its room's broadcasts are missed
+            pubsub = redis_client.pubsub()
+            await pubsub.subscribe(f"channel:{room_id}")
+            if room_id in room_listeners:
+                await pubsub.aclose()
+            else:
+                room_listeners[room_id] = asyncio.create_task(listen_to_room(room_id, pubsub))
+        
         if room_id in rooms:
-            await websocket.send_text(json.dumps({
-                "type": "room_update",
-                "room": rooms[room_id]
-            }))
+            queue.put_nowait(rooms[room_id].wire())
         
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
-            logger.info(f"WebSocket message received in room {room_id}: {message}")
+            message = orjson.loads(data)
+            logger.debug("WebSocket message received in room %s: %r", room_id, message)
             
-            if message["action"] == "start_game":
-                if room_id in rooms and len(rooms[room_id]["players"]) >= 2:
-                    rooms[room_id]["game_state"] = "playing"
-                    await broadcast_to_room(room_id, {
-                        "type": "game_started",
-                        "room": rooms[room_id]
-                    })
+            if message["action"] == "resync":
+                # Full snapshot for a client whose mirror has drifted from the deltas
+                if room_id in rooms:
+                    try:
+                        queue.put_nowait(rooms[room_id].wire())
+                    except asyncio.QueueFull:
+                        pass
+            
+            elif message["action"] == "start_game":
+                if room_id in rooms:
+                    room = rooms[room_id]
+                    async with room.lock:
+                        if len(room.players) >= 2:
+                            room.game_state = "playing"
+                            room.invalidate()
+                            await broadcast_to_room(room_id, {
+                                "type": "game_started",
+                                "room": room.to_wire()
+                            })
             
             elif message["action"] == "roll_dice":
                 if room_id in rooms:
                     room = rooms[room_id]
-                    current_player = room["players"][room["current_turn"]]
-                    if current_player["id"] == message["player_id"]:
-                        dice_result = random.randint(1, 6)
-                        room["dice_result"] = dice_result
-                        await broadcast_to_room(room_id, {
-                            "type": "dice_rolled",
-                            "dice": dice_result,
-                            "room": room
-                        })
+                    async with room.lock:
+                        current_player = room.players[room.current_turn]
+                        # A duplicate roll arriving before the move is ignored
+                        if current_player.id == message["player_id"] and room.dice_result is None:
+                            dice_result = random.randint(1, 6)
+                            room.dice_result = dice_result
+                            room.invalidate()
+                            await broadcast_to_room(room_id, {
+                                "type": "dice_rolled",
+                                "d": dice_result,
+                                "p": current_player.id
+                            })
             
             elif message["action"] == "move_piece":
                 if room_id in rooms:
                     room = rooms[room_id]
-                    current_player = room["players"][room["current_turn"]]
-                    if current_player["id"] == message["player_id"]:
-                        piece_id = message["piece_id"]
-                        dice_result = room["dice_result"]
-                        piece = next((p for p in current_player["pieces"] if p["id"] == piece_id), None)
-                        if piece:
-                            start_pos = {"red": 1, "blue": 40, "green": 14, "yellow": 27}
-                            safe_squares = [1, 9, 14, 22, 27, 35, 40, 48]
-                            home_entry = 51
-                            final_home = 57
-                            extra_turn = False
-
-                            if piece["home"] and dice_result == 6:
-                                piece["position"] = start_pos[current_player["color"]]
-                                piece["index"] = start_pos[current_player["color"]]
-                                piece["home"] = False
-                                extra_turn = True
-                            elif not piece["home"]:
-                                new_index = (piece["index"] + dice_result) % 52 if piece["index"] + dice_result <= home_entry else piece["index"] + dice_result
-                                if new_index > final_home:
-                                    new_index = final_home
-                                piece["position"] = (
-                                    str(new_index) if new_index <= home_entry else
-                                    f"rf{new_index}" if current_player["color"] == "red" else
-                                    f"bf{new_index}" if current_player["color"] == "blue" else
-                                    f"gf{new_index}" if current_player["color"] == "green" else
-                                    f"yf{new_index}"
-                                )
-                                piece["index"] = new_index
-                                if piece["index"] == final_home:
+                    async with room.lock:
+                        current_player = room.players[room.current_turn]
+                        # Without a pending roll (e.g. a duplicate move) there is nothing to apply
+                        if current_player.id == message["player_id"] and room.dice_result is not None:
+                            piece_id = message["piece_id"]
+                            dice_result = room.dice_result
+                            k = current_player.piece_by_id.get(piece_id)
+                            if k is not None:
+                                me = room.current_turn
+                                slot = me * 4 + k
+                                indices = room.piece_indices
+                                home = room.piece_home
+                                occupants = room.occupant_by_square
+                                extra_turn = False
+                                captures = []
+
+                                if home[slot] and dice_result == 6:
+                                    indices[slot] = START_POS[current_player.color]
+                                    home[slot] = False
+                                    occupants.setdefault(indices[slot], []).append(slot)
                                     extra_turn = True
-                                if piece["index"] not in safe_squares and piece["index"] <= home_entry:
-                                    for opponent in room["players"]:
-                                        if opponent["id"] != current_player["id"]:
-                                            for opp_piece in opponent["pieces"]:
-                                                if opp_piece["index"] == piece["index"] and not opp_piece["home"]:
-                                                    opp_piece["index"] = 0
-                                                    opp_piece["position"] = "home"
-                                                    opp_piece["home"] = True
-                                                    extra_turn = True
+                                elif not home[slot]:
+                                    new_index = (indices[slot] + dice_result) % 52 if indices[slot] + dice_result <= HOME_ENTRY else indices[slot] + dice_result
+                                    if new_index > FINAL_HOME:
+                                        new_index = FINAL_HOME
+                                    leave_square(occupants, indices[slot], slot)
+                                    indices[slot] = new_index
+                                    if new_index == FINAL_HOME:
+                                        extra_turn = True
+                                    if not (SAFE_MASK >> new_index) & 1 and new_index <= HOME_ENTRY:
+                                        owner = room.piece_owner
+                                        for i in list(occupants.get(new_index, ())):
+                                            if owner[i] != me:
+                                                leave_square(occupants, new_index, i)
+                                                indices[i] = 0
+                                                home[i] = True
+                                                extra_turn = True
+                                                captures.append(room.players[i // 4].piece_ids[i % 4])
+                                    occupants.setdefault(new_index, []).append(slot)
                             
-                            if all(p["index"] == final_home for p in current_player["pieces"]):
-                                room["game_state"] = "finished"
-                                await broadcast_to_room(room_id, {
-                                    "type": "game_won",
-                                    "winner": current_player["name"],
-                                    "room": room
-                                })
+                                if all(idx == FINAL_HOME for idx in indices[me * 4:me * 4 + 4]):
+                                    room.game_state = "finished"
+                                    room.invalidate()
+                                    await broadcast_to_room(room_id, {
+                                        "type": "game_won",
+                                        "winner": current_player.name,
+                                        "room": room.to_wire()
+                                    })
                             
-                            room["current_turn"] = room["current_turn"] if dice_result == 6 or extra_turn else (room["current_turn"] + 1) % len(room["players"])
-                            room["dice_result"] = None
+                                room.current_turn = room.current_turn if dice_result == 6 or extra_turn else (room.current_turn + 1) % len(room.players)
+                                room.dice_result = None
+                                room.invalidate()
                             
-                            await broadcast_to_room(room_id, {
-                                "type": "piece_moved",
-                                "room": room
-                            })
+                                # Delta only; clients apply it to their copy of the last room_update
+                                await broadcast_to_room(room_id, {
+                                    "type": "piece_moved",
+                                    "p": current_player.id,
+                                    "pc": piece_id,
+                                    "i": indices[slot],
+                                    "h": home[slot],
+                                    "x": extra_turn,
+                                    "cap": captures,
+                                    "t": room.current_turn
+                                })
     
     except WebSocketDisconnect:
-        if websocket in connections[room_id]:
-            connections[room_id].remove(websocket)
         logger.info(f"WebSocket disconnected from room {room_id}")
+    finally:
+        relay_task.cancel()
+        remove_connection(room_id, websocket)
+        if not connections.get(room_id) and room_id in room_listeners:
+            room_listeners.pop(room_id).cancel()
+
+def remove_connection(room_id: str, websocket: WebSocket) -> bool:
+    return connections.get(room_id, {}).pop(websocket, None) is not None
+
+# Per-client sender: broadcasters only enqueue, so one slow socket can't stall the room
+async def relay(room_id: str, websocket: WebSocket, queue: asyncio.Queue):
+    try:
+        while True:
+            payload = await queue.get()
+            await websocket.send_bytes(payload)
+    except Exception:
+        if remove_connection(room_id, websocket):
+            logger.info(f"Removed disconnected WebSocket from room {room_id}")
+
+async def close_websocket(websocket: WebSocket, code: int):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
 
 async def broadcast_to_room(room_id: str, message: dict):
+    await broadcast_frame(room_id, encode_frame(message))
+
+async def broadcast_frame(room_id: str, payload: bytes):
+    if redis_client is not None:
+        await redis_client.publish(f"channel:{room_id}", payload)
+    else:
+        await deliver_to_room(room_id, payload)
+
+# Subscribed while this process has connections in the room
+async def listen_to_room(room_id: str, pubsub):
+    try:
+        async for item in pubsub.listen():
+            if item["type"] == "message":
+                await deliver_to_room(room_id, item["data"])
+    except Exception:
+        logger.exception(f"Redis listener for room {room_id} failed")
+        if room_listeners.get(room_id) is asyncio.current_task():
+            del room_listeners[room_id]
+    finally:
+        await pubsub.aclose()
+
+async def deliver_to_room(room_id: str, payload: bytes):
     if room_id not in connections:
         return
     
+    targets = list(connections[room_id].items())
     disconnected = []
-    for websocket in connections[room_id]:
-        try:
-            await websocket.send_text(json.dumps(message))
-        except:
-            disconnected.append(websocket)
+    for start in range(0, len(targets), BROADCAST_BATCH_SIZE):
+        if start:
+            await asyncio.sleep(0)
+        for websocket, queue in targets[start:start + BROADCAST_BATCH_SIZE]:
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                disconnected.append(websocket)
     
     for ws in disconnected:
-        connections[room_id].remove(ws)
-        logger.info(f"Removed disconnected WebSocket from room {room_id}")
+        remove_connection(room_id, ws)
+        # 1013: try again later; the client can reconnect and resync
+        asyncio.create_task(close_websocket(ws, 1013))
+        logger.info(f"Dropped slow WebSocket from room {room_id}")
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=False,
+    )